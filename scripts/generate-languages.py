@@ -1,10 +1,16 @@
+import filecmp
+import heapq
 import os
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # =========================
 # CONFIG
 # =========================
-GITHUB_API = "https://api.github.com"
+GITHUB_GRAPHQL = "https://api.github.com/graphql"
 TOKEN = os.environ.get("GITHUB_TOKEN")
 
 if not TOKEN:
@@ -19,60 +25,137 @@ OUTPUT_DIR = "stats"
 OUTPUT_FILE = os.path.join(OUTPUT_DIR, "languages.svg")
 TOP_N = 5
 
+# Retries only cover 429 and 5xx; 403 and GraphQL RATE_LIMITED are handled
+# by post_graphql, since urllib3 can't tell them apart from real failures
+MAX_RATE_LIMIT_RETRIES = 5
+SECONDARY_LIMIT_WAIT = 60
+
+# One pooled session so every call reuses the same keep-alive connection
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=8,
+        backoff_factor=1.0,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        # The GraphQL query is read-only, so retrying the POST is safe
+        allowed_methods=["GET", "POST"],
+    ),
+))
+
 
 # =========================
-# FETCH ALL REPOS (PUBLIC + PRIVATE)
+# RATE LIMIT
 # =========================
-def fetch_all_repos():
-    repos = []
-    page = 1
+def rate_limit_wait(res):
+    """Seconds to wait before the next call, or 0 if we are not throttled."""
+    # Secondary rate limit: GitHub says exactly how long to back off
+    if res.status_code == 403 and "Retry-After" in res.headers:
+        return int(res.headers["Retry-After"])
+
+    # Primary rate limit: wait for the window to reset
+    if res.headers.get("X-RateLimit-Remaining") == "0":
+        reset = int(res.headers.get("X-RateLimit-Reset", 0))
+        return max(0, reset - time.time()) + 1
+
+    # Secondary rate limit without Retry-After: GitHub asks for at least 60s
+    if res.status_code == 403 and "rate limit" in res.text.lower():
+        return SECONDARY_LIMIT_WAIT
+
+    return 0
+
+
+def is_rate_limited(errors):
+    return any(error.get("type") == "RATE_LIMITED" for error in errors)
+
+
+# Earliest time the next GraphQL call may go out (time.time() seconds)
+next_call_at = 0.0
+
+
+def post_graphql(payload):
+    global next_call_at
+
+    for _ in range(MAX_RATE_LIMIT_RETRIES + 1):
+        # Honour the wait from the previous response only when another call
+        # is actually made, so the last page never blocks the run
+        delay = next_call_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        res = SESSION.post(GITHUB_GRAPHQL, json=payload)
+        wait = rate_limit_wait(res)
+        next_call_at = time.time() + wait
+
+        if res.status_code == 403 and wait:
+            continue
 
-    while True:
-        url = f"{GITHUB_API}/user/repos?per_page=100&page={page}"
-        res = requests.get(url, headers=HEADERS)
         res.raise_for_status()
 
-        data = res.json()
-        if not data:
-            break
+        # GraphQL reports an exhausted quota as HTTP 200 with an error body
+        body = res.json()
+        if is_rate_limited(body.get("errors") or []):
+            next_call_at = time.time() + (wait or SECONDARY_LIMIT_WAIT)
+            continue
 
-        repos.extend(data)
-        page += 1
+        return body
 
-    return repos
+    raise RuntimeError("GitHub rate limit still hit after retrying")
 
 
 # =========================
-# FILTER REPO (EXCLUDE)
+# AGGREGATE LANGUAGE BYTES (PUBLIC + PRIVATE)
 # =========================
-def is_valid_repo(repo):
-    if repo.get("fork"):
-        return False
-    if repo.get("archived"):
-        return False
-    return True
+# Forks and archived repos are excluded server-side, and each page carries
+# the languages of its repos, so one request covers up to 100 repos.
+REPOS_QUERY = """
+query($cursor: String) {
+  viewer {
+    repositories(
+      first: 100
+      after: $cursor
+      affiliations: [OWNER, COLLABORATOR, ORGANIZATION_MEMBER]
+      ownerAffiliations: [OWNER, COLLABORATOR, ORGANIZATION_MEMBER]
+      isFork: false
+      isArchived: false
+    ) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        languages(first: 100) {
+          edges { size node { name } }
+        }
+      }
+    }
+  }
+}
+"""
 
 
-# =========================
-# AGGREGATE LANGUAGE BYTES
-# =========================
-def aggregate_languages(repos):
+def aggregate_languages():
     totals = {}
+    cursor = None
 
-    for repo in repos:
-        if not is_valid_repo(repo):
-            continue
-
-        lang_url = repo.get("languages_url")
-        if not lang_url:
-            continue
+    while True:
+        body = post_graphql({
+            "query": REPOS_QUERY,
+            "variables": {"cursor": cursor},
+        })
+        if body.get("errors"):
+            raise RuntimeError(f"GraphQL query failed: {body['errors']}")
 
-        res = requests.get(lang_url, headers=HEADERS)
-        res.raise_for_status()
-        languages = res.json()
+        repositories = body["data"]["viewer"]["repositories"]
+        for repo in repositories["nodes"]:
+            for edge in repo["languages"]["edges"]:
+                lang = edge["node"]["name"]
+                totals[lang] = totals.get(lang, 0) + edge["size"]
 
-        for lang, size in languages.items():
-            totals[lang] = totals.get(lang, 0) + size
+        page_info = repositories["pageInfo"]
+        if not page_info["hasNextPage"]:
+            break
+        cursor = page_info["endCursor"]
 
     return totals
 
@@ -85,16 +168,14 @@ def calculate_percentages(language_bytes):
     if total == 0:
         return []
 
-    result = []
-    for lang, size in language_bytes.items():
-        percent = (size / total) * 100
-        result.append({
-            "name": lang,
-            "percent": round(percent, 1)
-        })
-
-    result.sort(key=lambda x: x["percent"], reverse=True)
-    return result[:TOP_N]
+    return heapq.nlargest(
+        TOP_N,
+        (
+            {"name": lang, "percent": round((size / total) * 100, 1)}
+            for lang, size in language_bytes.items()
+        ),
+        key=lambda x: x["percent"],
+    )
 
 
 # =========================
@@ -141,8 +222,46 @@ LANG_COLORS = {
     "Markdown": "#083fa1",
     "Other": "#586069",
 }
-
-def generate_svg(languages):
+DEFAULT_COLOR = "#8b949e"
+
+# Static part of the card; only the size and rows change between runs
+SVG_STYLE = """<defs>
+<linearGradient id="bgGradient" x1="0%" y1="0%" x2="100%" y2="100%">
+<stop offset="0%" style="stop-color:#0d1117;stop-opacity:1" />
+<stop offset="100%" style="stop-color:#161b22;stop-opacity:1" />
+</linearGradient>
+</defs>
+<style>
+text { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Helvetica, Arial, sans-serif; font-size: 11px; fill: #c9d1d9; }
+.title { font-weight: 600; font-size: 14px; fill: #f0f6fc; }
+.bg { fill: url(#bgGradient); stroke: #bcc4cdff; stroke-width: 4; rx: 6; }
+.bar { rx: 3; }
+.label { fill: #f0f6fc; font-weight: 500; }
+.percent { fill: #8b949e; }
+.track { fill: none; stroke: #30363d; stroke-width: 1; rx: 3; }
+</style>"""
+
+SVG_HEADER_TPL = (
+    '<svg width="{width}" height="{height}" viewBox="0 0 {width} {height}" xmlns="http://www.w3.org/2000/svg">\n'
+    '{style}\n'
+    '<rect x="0" y="0" width="{width}" height="{height}" class="bg" />\n'
+    '<text x="{padding}" y="{title_y}" class="title">Most Used Languages</text>\n'
+)
+SVG_FOOTER = '</svg>'
+
+
+ROW_TPL = (
+    # FULL TRACK (100%)
+    '<rect x="{padding}" y="{y}" width="{bar_max_width}" height="{bar_height}" class="track" />\n'
+    # FILLED BAR (actual percentage)
+    '<rect x="{padding}" y="{y}" width="{bar_width}" height="{bar_height}" class="bar" fill="{color}" rx="3" />\n'
+    # Language name (positioned right of bar, like example)
+    '<text x="{label_x}" y="{text_y}" class="label">{name}</text>\n'
+    # Percentage (right-aligned at end, like example)
+    '<text x="{percent_x}" y="{text_y}" text-anchor="end" class="percent">{percent}%</text>\n'
+)
+
+def generate_svg(languages, fh):
     width = 300
     bar_height = 8
     row_height = 18
@@ -151,78 +270,61 @@ def generate_svg(languages):
     title_height = 25
 
     height = padding * 2 + title_height + row_height * len(languages)
-
-    svg = [
-        f'<svg width="{width}" height="{height}" viewBox="0 0 {width} {height}" xmlns="http://www.w3.org/2000/svg">',
-        '<defs>',
-        '<linearGradient id="bgGradient" x1="0%" y1="0%" x2="100%" y2="100%">',
-        '<stop offset="0%" style="stop-color:#0d1117;stop-opacity:1" />',
-        '<stop offset="100%" style="stop-color:#161b22;stop-opacity:1" />',
-        '</linearGradient>',
-        '</defs>',
-        '<style>',
-        'text { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Helvetica, Arial, sans-serif; font-size: 11px; fill: #c9d1d9; }',
-        '.title { font-weight: 600; font-size: 14px; fill: #f0f6fc; }',
-        '.bg { fill: url(#bgGradient); stroke: #bcc4cdff; stroke-width: 4; rx: 6; }',
-        '.bar { rx: 3; }',
-        '.label { fill: #f0f6fc; font-weight: 500; }',
-        '.percent { fill: #8b949e; }',
-        '.track { fill: none; stroke: #30363d; stroke-width: 1; rx: 3; }' ,
-        '</style>',
-
-        f'<rect x="0" y="0" width="{width}" height="{height}" class="bg" />',
-
-        f'<text x="{padding}" y="{padding + 12}" class="title">Most Used Languages</text>',
-    ]
-
     y = padding + title_height
 
-    for lang in languages:
-        percent = lang["percent"]
-        bar_width = (percent / 100) * bar_max_width
-        color = LANG_COLORS.get(lang["name"], "#8b949e")
-
-        # FULL TRACK (100%)
-        svg.append(
-            f'<rect x="{padding}" y="{y}" width="{bar_max_width}" height="{bar_height}" '
-            f'class="track" />'
-        )
-        # FILLED BAR (actual percentage)
-        svg.append(
-            f'<rect x="{padding}" y="{y}" width="{bar_width}" height="{bar_height}" '
-            f'class="bar" fill="{color}" rx="3" />'
-        )
-        # Language name (positioned right of bar, like example)
-        svg.append(
-            f'<text x="{padding + bar_max_width + 8}" y="{y + 7}" class="label">{lang["name"]}</text>'
-        )
-        # Percentage (right-aligned at end, like example)
-        svg.append(
-            f'<text x="{width - padding}" y="{y + 7}" text-anchor="end" class="percent">{percent}%</text>'
-        )
+    fh.write(SVG_HEADER_TPL.format(
+        width=width,
+        height=height,
+        padding=padding,
+        title_y=padding + 12,
+        style=SVG_STYLE,
+    ))
 
+    for lang in languages:
+        fh.write(ROW_TPL.format(
+            padding=padding,
+            y=y,
+            text_y=y + 7,
+            bar_max_width=bar_max_width,
+            bar_height=bar_height,
+            bar_width=(lang["percent"] / 100) * bar_max_width,
+            color=LANG_COLORS.get(lang["name"], DEFAULT_COLOR),
+            label_x=padding + bar_max_width + 8,
+            percent_x=width - padding,
+            name=lang["name"],
+            percent=lang["percent"],
+        ))
         y += row_height
 
-    svg.append("</svg>")
-    return "\n".join(svg)
+    fh.write(SVG_FOOTER)
 
 # =========================
 # MAIN
 # =========================
 def main():
-    repos = fetch_all_repos()
-    language_bytes = aggregate_languages(repos)
+    language_bytes = aggregate_languages()
     top_languages = calculate_percentages(language_bytes)
 
     if not top_languages:
         print("No language data found.")
         return
 
-    svg_content = generate_svg(top_languages)
-
     os.makedirs(OUTPUT_DIR, exist_ok=True)
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        f.write(svg_content)
+    tmp_file = OUTPUT_FILE + ".tmp"
+
+    try:
+        with open(tmp_file, "w", encoding="utf-8", newline="") as f:
+            generate_svg(top_languages, f)
+
+        # Leave the file (and its mtime) alone when nothing changed
+        if os.path.exists(OUTPUT_FILE) and filecmp.cmp(tmp_file, OUTPUT_FILE, shallow=False):
+            print("languages.svg unchanged")
+            return
+
+        os.replace(tmp_file, OUTPUT_FILE)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
 
     print("languages.svg generated successfully")
 